@@ -6,28 +6,20 @@
 
 import sys
 import os
+import re
 import logging
 import ftplib
 import gzip
 import datetime
-from typing import Optional, List, Dict
-
-from sqlalchemy.engine.url import URL
-from sqlalchemy import create_engine, exc, MetaData, Table, Column, Integer, String, Text
-from sqlalchemy.engine.base import Engine
-import pandas as pd
-try:
-    import cx_Oracle
-except ImportError:
-    cx_Oracle = None
-try:
-    import psycopg2
-except ImportError:
-    psycopg2 = None
-try:
-    import MySQLdb
-except ImportError:
-    MySQLdb = None
+from typing import Optional, List, Dict, Tuple, TYPE_CHECKING
+
+# pandas, SQLAlchemy and the DBAPI drivers are imported lazily inside the functions
+# that need them so that --help does not load them. Frontfiles are fetched before the
+# engine is created so that empty frontfile days never import SQLAlchemy or touch the DB.
+# SQLAlchemy imports the DBAPI driver for the selected dialect on create_engine().
+if TYPE_CHECKING:
+    import pandas as pd
+    from sqlalchemy.engine.base import Engine
 
 class AppLogger:
 
@@ -42,7 +34,7 @@ class AppLogger:
             "%(asctime)s : %(levelname)s : %(name)s : %(funcName)s :%(message)s"
         )
 
-        file_handler = logging.FileHandler(log_file)
+        file_handler = logging.FileHandler(log_file, delay=True)
         file_handler.setLevel(file_level)
         file_handler.setFormatter(formatter)
 
@@ -55,7 +47,7 @@ class AppLogger:
 
         return logger
 
-def count_rows(engine: Engine, tbl_name: str) -> int:
+def count_rows(engine: 'Engine', tbl_name: str) -> int:
 
     if not engine.dialect.has_table(engine, tbl_name):
         logger.error('Destination table does not exist.')
@@ -63,6 +55,354 @@ def count_rows(engine: Engine, tbl_name: str) -> int:
 
     return int(engine.execute("""SELECT count(*) FROM "{0}" """.format(tbl_name)).fetchone()[0])
 
+def run_concurrently(func, items: list, max_workers: int) -> list:
+
+    from concurrent.futures import ThreadPoolExecutor
+
+    # exceptions raised in worker threads are re-raised when collecting results
+    with ThreadPoolExecutor(max_workers=max(1, min(len(items), max_workers))) as executor:
+        return list(executor.map(func, items))
+
+def split_df(df: 'pd.DataFrame', n_chunks: int) -> List['pd.DataFrame']:
+
+    '''
+    Splits a dataframe into at most n_chunks contiguous chunks.
+    '''
+
+    chunk_size = max(1, -(-len(df) // n_chunks))
+
+    return [df.iloc[i:i + chunk_size] for i in range(0, len(df), chunk_size)]
+
+def get_partitions(engine: 'Engine', tbl_name: str) -> List[str]:
+
+    '''
+    Returns partition names of a partitioned Postgres table or an empty list.
+    '''
+
+    if engine.dialect.driver != 'psycopg2':
+        return []
+
+    result = engine.execute("""
+        SELECT c.relname
+        FROM pg_inherits i
+            JOIN pg_class c ON c.oid = i.inhrelid
+        WHERE i.inhparent = '"{0}"'::regclass
+        ORDER BY c.relname
+    """.format(tbl_name))
+
+    return [row[0] for row in result]
+
+def create_partitioned_table(
+    engine: 'Engine',
+    tbl_name: str,
+    unique_col: List[str],
+    partitions: int,
+    primary_key: Optional[bool]=True,
+    unlogged: Optional[bool]=False
+    ) -> None:
+
+    '''
+    Creates the destination table hash-partitioned on the unique column (Postgres only).
+    '''
+
+    engine.execute("""
+        CREATE TABLE "{0}" (
+            "{1}" integer NOT NULL,
+            smiles text,
+            std_inchi text,
+            std_inchikey varchar(27),
+            content_hash varchar(32){2}
+        ) PARTITION BY HASH ("{1}")
+    """.format(tbl_name, unique_col[0], ',\n            PRIMARY KEY ("{0}")'.format(unique_col[0]) if primary_key else ''))
+
+    for i in range(partitions):
+        engine.execute("""
+            CREATE {3}TABLE "{0}_p{1}" PARTITION OF "{0}"
+                FOR VALUES WITH (MODULUS {2}, REMAINDER {1})
+        """.format(tbl_name, i, partitions, 'UNLOGGED ' if unlogged else ''))
+
+def create_shadow_table(
+    engine: 'Engine',
+    tbl_name: str,
+    shadow_tbl_name: str,
+    unique_col: List[str],
+    partition_list: Optional[List[str]]=None
+    ) -> None:
+
+    '''
+    Creates an unlogged copy of the table structure without indexes (Postgres only).
+    '''
+
+    engine.execute("""DROP TABLE IF EXISTS "{0}" """.format(shadow_tbl_name))
+
+    if partition_list:
+        create_partitioned_table(engine, shadow_tbl_name, unique_col, len(partition_list),
+            primary_key=False, unlogged=True)
+    else:
+        engine.execute("""CREATE UNLOGGED TABLE "{0}" (LIKE "{1}")""".format(shadow_tbl_name, tbl_name))
+
+def set_logged(engine: 'Engine', tbl_name: str, partition_list: Optional[List[str]]=None) -> None:
+
+    def set_tbl_logged(name):
+        engine.execute("""ALTER TABLE "{0}" SET LOGGED""".format(name))
+
+    # a partitioned parent holds no data, only its partitions are rewritten
+    if partition_list:
+        run_concurrently(set_tbl_logged, partition_list, engine.pool.size())
+    else:
+        set_tbl_logged(tbl_name)
+
+def carry_over_rows(
+    engine: 'Engine',
+    tbl_name: str,
+    shadow_tbl_name: str,
+    unique_col: List[str]
+    ) -> int:
+
+    '''
+    Copies rows present only in the live table (e.g. loaded from frontfiles) into the shadow table.
+    Returns the number of rows copied.
+    '''
+
+    cols = ', '.join('"{0}"'.format(col) for col in
+        [unique_col[0], 'smiles', 'std_inchi', 'std_inchikey', 'content_hash'])
+
+    result = engine.execute("""
+        INSERT INTO "{1}" ({2})
+        SELECT DISTINCT ON ("{3}") {2}
+        FROM "{0}" T1
+        WHERE NOT EXISTS (
+            SELECT 1 FROM "{1}" T2 WHERE T2."{3}" = T1."{3}")
+    """.format(tbl_name, shadow_tbl_name, cols, unique_col[0]))
+
+    return result.rowcount
+
+def count_changed_rows(
+    engine: 'Engine',
+    tbl_name: str,
+    shadow_tbl_name: str,
+    unique_col: List[str]
+    ) -> int:
+
+    '''
+    Counts live rows whose content hash differs from the shadow row with the same ID.
+    '''
+
+    return int(engine.execute("""
+        SELECT count(*)
+        FROM "{0}" T1
+            JOIN "{1}" T2 ON T2."{2}" = T1."{2}"
+        WHERE T1.content_hash IS NOT NULL
+            AND T1.content_hash IS DISTINCT FROM T2.content_hash
+    """.format(tbl_name, shadow_tbl_name, unique_col[0])).fetchone()[0])
+
+def swap_tables(
+    engine: 'Engine',
+    tbl_name: str,
+    shadow_tbl_name: str,
+    unique_col: List[str],
+    partition_list: Optional[List[str]]=None,
+    shadow_partition_list: Optional[List[str]]=None
+    ) -> int:
+
+    '''
+    Atomically replaces the table with its shadow by renaming both within one transaction.
+    Writes to the live table are blocked while rows written since the carry-over are copied.
+    Primary key indexes are renamed along with the tables so that names stay consistent.
+    The previous table is kept as <tbl_name>_old. Returns the number of rows copied.
+    '''
+
+    old_tbl_name = tbl_name + '_old'
+
+    def rename_table(conn, src, dst):
+        conn.execute("""ALTER TABLE "{0}" RENAME TO "{1}" """.format(src, dst))
+        conn.execute("""ALTER INDEX IF EXISTS "{0}_pkey" RENAME TO "{1}_pkey" """.format(src, dst))
+
+    with engine.begin() as conn:
+        conn.execute("""LOCK TABLE "{0}" IN EXCLUSIVE MODE""".format(tbl_name))
+        late_count = carry_over_rows(conn, tbl_name, shadow_tbl_name, unique_col)
+
+        for name in [tbl_name] + (partition_list or []):
+            rename_table(conn, name, name.replace(tbl_name, old_tbl_name, 1))
+        for name in [shadow_tbl_name] + (shadow_partition_list or []):
+            rename_table(conn, name, name.replace(shadow_tbl_name, tbl_name, 1))
+
+    return late_count
+
+def check_memory_setting(value: str) -> str:
+
+    '''
+    Validates a Postgres memory setting such as 512MB or 2GB before it is used in SQL.
+    '''
+
+    if not re.fullmatch(r'\d+\s*(kB|MB|GB|TB)?', value):
+        raise ValueError("Invalid memory setting '{0}'. Expected e.g. 512MB or 2GB.".format(value))
+
+    return value
+
+def add_primary_key(
+    engine: 'Engine',
+    tbl_name: str,
+    unique_col: List[str],
+    partition_list: Optional[List[str]]=None,
+    maintenance_work_mem: Optional[str]=None
+    ) -> None:
+
+    '''
+    Adds primary key to the table. For a partitioned table the per-partition keys
+    are built in parallel and then attached when the key is added to the parent.
+    maintenance_work_mem is only set when given, otherwise the server setting is kept.
+    '''
+
+    if maintenance_work_mem is not None:
+        check_memory_setting(maintenance_work_mem)
+
+    def build_pkey(name, drop_existing=False):
+        with engine.begin() as conn:
+            if engine.dialect.driver == 'psycopg2' and maintenance_work_mem is not None:
+                conn.execute("""SET LOCAL maintenance_work_mem = '{0}'""".format(maintenance_work_mem))
+            # partition keys left over from an interrupted build would block a new one
+            if drop_existing:
+                conn.execute("""ALTER TABLE "{0}" DROP CONSTRAINT IF EXISTS "{0}_pkey" """.format(name))
+            conn.execute("""ALTER TABLE "{0}" ADD PRIMARY KEY ("{1}")""".format(name, unique_col[0]))
+
+    if partition_list:
+        run_concurrently(lambda name: build_pkey(name, drop_existing=True), partition_list,
+            engine.pool.size())
+
+    build_pkey(tbl_name)
+
+def content_hash(df: 'pd.DataFrame') -> 'pd.Series':
+
+    '''
+    Returns md5 hex digest of the structure columns for every row.
+    '''
+
+    import hashlib
+
+    cols = df[['smiles', 'std_inchi', 'std_inchikey']].fillna('').astype(str)
+    row_str = cols['smiles'] + '\t' + cols['std_inchi'] + '\t' + cols['std_inchikey']
+
+    return row_str.map(lambda row: hashlib.md5(row.encode()).hexdigest())
+
+def get_stored_hashes(
+    engine: 'Engine',
+    tbl_name: str,
+    unique_col: List[str],
+    ids: List[int],
+    batch_size: Optional[int]=1000
+    ) -> Dict[int, Optional[str]]:
+
+    '''
+    Fetches stored content hashes for the given IDs in batches using the primary key.
+    Batches are kept within Oracle's limit of 1000 expressions in an IN list.
+    '''
+
+    stored_hashes = {}
+    for i in range(0, len(ids), batch_size):
+        result = engine.execute("""SELECT "{1}", content_hash FROM "{0}" WHERE "{1}" IN ({2})""".format(
+            tbl_name, unique_col[0], ', '.join(str(int(x)) for x in ids[i:i + batch_size])))
+        stored_hashes.update(result.fetchall())
+
+    return stored_hashes
+
+def get_stored_structures(
+    engine: 'Engine',
+    tbl_name: str,
+    unique_col: List[str],
+    ids: List[int],
+    batch_size: Optional[int]=1000
+    ) -> 'pd.DataFrame':
+
+    '''
+    Fetches stored structure columns for the given IDs in batches using the primary key.
+    '''
+
+    import pandas as pd
+
+    rows = []
+    for i in range(0, len(ids), batch_size):
+        result = engine.execute("""SELECT "{1}", smiles, std_inchi, std_inchikey FROM "{0}" WHERE "{1}" IN ({2})""".format(
+            tbl_name, unique_col[0], ', '.join(str(int(x)) for x in ids[i:i + batch_size])))
+        rows.extend(result.fetchall())
+
+    return pd.DataFrame(rows, columns=[unique_col[0], 'smiles', 'std_inchi', 'std_inchikey'])
+
+def delete_rows(
+    engine: 'Engine',
+    tbl_name: str,
+    unique_col: List[str],
+    ids: List[int],
+    batch_size: Optional[int]=1000
+    ) -> None:
+
+    for i in range(0, len(ids), batch_size):
+        engine.execute("""DELETE FROM "{0}" WHERE "{1}" IN ({2})""".format(
+            tbl_name, unique_col[0], ', '.join(str(int(x)) for x in ids[i:i + batch_size])))
+
+def select_upsert_rows(
+    df: 'pd.DataFrame',
+    stored_hashes: Dict[int, Optional[str]],
+    unique_col: List[str],
+    computed_hashes: Optional[Dict[int, str]]=None
+    ) -> Tuple['pd.DataFrame', 'pd.DataFrame', 'pd.DataFrame']:
+
+    '''
+    Splits rows into new rows, stored rows with changed content and unchanged stored rows
+    without a content hash. Hashes missing from the table are taken from computed_hashes,
+    computed from the stored structures; rows without either count as changed.
+    '''
+
+    computed_hashes = computed_hashes or {}
+    is_stored = df[unique_col[0]].isin(list(stored_hashes.keys()))
+    is_missing_hash = is_stored & df[unique_col[0]].map(stored_hashes).isna()
+    stored_hash = df[unique_col[0]].map(stored_hashes).fillna(df[unique_col[0]].map(computed_hashes))
+    is_changed = is_stored & (stored_hash != df['content_hash'])
+    is_backfill = is_missing_hash & ~is_changed
+
+    return df[~is_stored], df[is_changed], df[is_backfill]
+
+def upsert_rows(
+    engine: 'Engine',
+    tbl_name: str,
+    unique_col: List[str],
+    df: 'pd.DataFrame'
+    ) -> Tuple['pd.DataFrame', int]:
+
+    '''
+    Replaces stored rows whose content hash differs and returns the rows not yet stored
+    together with the number of replaced rows. Stored rows without a content hash,
+    e.g. loaded before the column was added, are compared by hashing their stored structure
+    and only get the hash filled in when the structure is unchanged.
+    '''
+
+    from sqlalchemy import text
+
+    stored_hashes = get_stored_hashes(engine, tbl_name, unique_col, df[unique_col[0]].tolist())
+
+    computed_hashes = {}
+    missing_ids = [row_id for row_id, row_hash in stored_hashes.items() if row_hash is None]
+    if missing_ids:
+        stored_df = get_stored_structures(engine, tbl_name, unique_col, missing_ids)
+        computed_hashes = dict(zip(stored_df[unique_col[0]], content_hash(stored_df)))
+
+    new_df, changed_df, backfill_df = select_upsert_rows(df, stored_hashes, unique_col, computed_hashes)
+
+    if not backfill_df.empty:
+        with engine.begin() as conn:
+            conn.execute(text("""UPDATE "{0}" SET content_hash = :content_hash WHERE "{1}" = :id""".format(
+                tbl_name, unique_col[0])), [{'content_hash': row_hash, 'id': int(row_id)}
+                    for row_id, row_hash in zip(backfill_df[unique_col[0]], backfill_df['content_hash'])])
+
+    # deleting and reloading in one transaction so a failed load keeps the stored rows
+    if not changed_df.empty:
+        with engine.begin() as conn:
+            delete_rows(conn, tbl_name, unique_col, changed_df[unique_col[0]].tolist())
+            changed_df.to_sql(tbl_name, conn, if_exists='append', index=False, method='multi',
+                chunksize=1000)
+
+    return new_df, len(changed_df)
+
 def ftp_connect(ftp_usr: str, ftp_psw: str, ftp_address: Optional[str]='ftp-private.ebi.ac.uk'):
     # connecting to FTP server
     try:
@@ -72,7 +412,9 @@ def ftp_connect(ftp_usr: str, ftp_psw: str, ftp_address: Optional[str]='ftp-priv
         logger.error('Failed to connect to FTP server. Please check connection details.\n{}'.format(e))
         raise
 
-def parse_chemicals_file(tsv_path: str, unique_col: List[str]) -> pd.DataFrame:
+def parse_chemicals_file(tsv_path: str, unique_col: List[str]) -> 'pd.DataFrame':
+
+    import pandas as pd
 
     try:
         with gzip.open(tsv_path) as f:
@@ -85,6 +427,7 @@ def parse_chemicals_file(tsv_path: str, unique_col: List[str]) -> pd.DataFrame:
     df = df[['SureChEMBL ID','SMILES','Standard InChi','Standard InChiKey']]
     df.columns = ['schembl_chem_id', 'smiles', 'std_inchi', 'std_inchikey']
     df.drop_duplicates(subset=unique_col, keep='first', inplace=True)
+    df['content_hash'] = content_hash(df)
 
     return df
 
@@ -130,7 +473,9 @@ def get_tsv_dir(ftp: ftplib.FTP) -> Dict[str, str]:
 def get_frontfile_df(
     dir_dict: Dict[str, str],
     ftp: ftplib.FTP,
-    unique_col: List[str]) -> pd.DataFrame:
+    unique_col: List[str]) -> 'pd.DataFrame':
+
+    import pandas as pd
 
     parent_dir = ftp.pwd()
     # retrieving new compounds
@@ -152,19 +497,31 @@ def get_frontfile_df(
     return frontfile_df
 
 def load_backfile(
-    engine: Engine,
+    engine: 'Engine',
     unique_col: List[str],
     logger: logging.Logger,
     ftp_usr: str,
     ftp_psw: str,
     start_year: Optional[int]=1950,
-    end_year: Optional[int]=2018
+    end_year: Optional[int]=2018,
+    partition_list: Optional[List[str]]=None,
+    maintenance_work_mem: Optional[str]=None,
+    rebuild: Optional[bool]=False,
+    min_loaded_ratio: Optional[float]=0.5
     ) -> None:
 
     '''
     Loads backfiles for a specified range in years.
+    Rebuild mode loads into a shadow table and swaps it with the live table at the end.
     '''
 
+    import pandas as pd
+
+    # previous table is kept after a swap until the user drops it
+    if rebuild is True and engine.dialect.has_table(engine, tbl_name + '_old'):
+        logger.error('Table {0}_old from a previous rebuild still exists. Drop it before rebuilding.'.format(tbl_name))
+        sys.exit(1)
+
     # connecting to FTP server
     ftp = ftp_connect(ftp_usr, ftp_psw)
 
@@ -173,11 +530,22 @@ def load_backfile(
     ftp.cwd(backfile_dir)
     year_list = ftp.nlst()
 
-    # dropping primary key
-    try:
-        engine.execute("""ALTER TABLE "{0}" DROP CONSTRAINT "{0}_pkey" """.format(tbl_name))
-    except Exception as e:
-        logger.info('Failed to drop PK constraint.\n{}'.format(e))
+    load_tbl_name, load_partition_list = tbl_name, partition_list
+    if rebuild is True:
+        # live table is left untouched until the swap
+        load_tbl_name = tbl_name + '_shadow'
+        logger.info('Creating shadow table {0}.'.format(load_tbl_name))
+        create_shadow_table(engine, tbl_name, load_tbl_name, unique_col, partition_list)
+        load_partition_list = get_partitions(engine, load_tbl_name)
+    else:
+        # dropping primary key
+        try:
+            engine.execute("""ALTER TABLE "{0}" DROP CONSTRAINT "{0}_pkey" """.format(tbl_name))
+        except Exception as e:
+            logger.info('Failed to drop PK constraint.\n{}'.format(e))
+
+    # IDs written to the shadow table, used to validate it before the swap
+    loaded_ids = []
 
     # iterating every year in the list
     for year in year_list:
@@ -224,17 +592,90 @@ def load_backfile(
 
         year_df.drop_duplicates(subset=unique_col, keep='first', inplace=True)
 
-        dfloader(year_df, engine, tbl_name, unique_col=unique_col)
+        # shadow table is deduplicated once after all years are loaded
+        dfloader(year_df, engine, load_tbl_name, unique_col=unique_col,
+            drop_duplicates=rebuild is not True, partition_list=load_partition_list)
+        if rebuild is True:
+            loaded_ids.append(year_df[unique_col[0]])
         logger.info('Finished loading {}.'.format(year))
 
+    if rebuild is True:
+        expected_count = int(pd.concat(loaded_ids).nunique()) if loaded_ids else 0
+        rebuild_table(engine, tbl_name, load_tbl_name, unique_col, logger, partition_list,
+            load_partition_list, maintenance_work_mem, expected_count=expected_count,
+            min_loaded_ratio=min_loaded_ratio)
+        return
+
     logger.info('Adding primary key.')
     try:
-        engine.execute("""ALTER TABLE "{0}" ADD PRIMARY KEY ("{1}")""".format(tbl_name, unique_col[0]))
-    except:
-        pass
+        add_primary_key(engine, tbl_name, unique_col, partition_list, maintenance_work_mem)
+    except Exception as e:
+        logger.error('Failed to add primary key.\n{}'.format(e))
+
+def rebuild_table(
+    engine: 'Engine',
+    tbl_name: str,
+    shadow_tbl_name: str,
+    unique_col: List[str],
+    logger: logging.Logger,
+    partition_list: Optional[List[str]]=None,
+    shadow_partition_list: Optional[List[str]]=None,
+    maintenance_work_mem: Optional[str]=None,
+    expected_count: Optional[int]=0,
+    min_loaded_ratio: Optional[float]=0.5
+    ) -> None:
+
+    '''
+    Finalises a loaded shadow table and swaps it with the live table if row counts validate.
+    The shadow table must hold exactly the expected_count distinct IDs that were loaded
+    and at least min_loaded_ratio of the live row count, which catches partial backfile loads.
+    Backfile rows replace live rows with the same ID, including upsert corrections.
+    '''
+
+    logger.info('Dropping duplicates in {0}.'.format(shadow_tbl_name))
+    drop_sql_duplicates(engine, shadow_tbl_name, unique_col, shadow_partition_list)
+
+    # validating row counts before replacing the live table
+    loaded_count = count_rows(engine, shadow_tbl_name)
+    if loaded_count == 0 or loaded_count != expected_count:
+        logger.error("""Shadow table has {0} rows while {1} distinct compounds were loaded. Keeping the live table and {2} for inspection.""".format(
+            loaded_count, expected_count, shadow_tbl_name))
+        sys.exit(1)
+
+    live_count = count_rows(engine, tbl_name)
+    if loaded_count < min_loaded_ratio * live_count:
+        logger.error("""Shadow table has {0} rows, less than {1} of the {2} rows in {3}. Keeping the live table and {4} for inspection.""".format(
+            loaded_count, min_loaded_ratio, live_count, tbl_name, shadow_tbl_name))
+        sys.exit(1)
+
+    # keeping rows that are not in the backfiles, e.g. loaded from frontfiles
+    logger.info('Carrying over rows missing from {0}.'.format(shadow_tbl_name))
+    carried_count = carry_over_rows(engine, tbl_name, shadow_tbl_name, unique_col)
+
+    set_logged(engine, shadow_tbl_name, shadow_partition_list)
+
+    logger.info('Adding primary key to {0}.'.format(shadow_tbl_name))
+    add_primary_key(engine, shadow_tbl_name, unique_col, shadow_partition_list, maintenance_work_mem)
+    with engine.begin() as conn:
+        conn.execute("""ANALYZE "{0}" """.format(shadow_tbl_name))
+
+    replaced_count = count_changed_rows(engine, tbl_name, shadow_tbl_name, unique_col)
+    if replaced_count:
+        logger.warning("""{0} compounds in {1} differ from the backfiles and will be replaced by the backfile version, including upsert corrections.""".format(
+            replaced_count, tbl_name))
+
+    new_tbl_count = count_rows(engine, shadow_tbl_name)
+
+    logger.info('Swapping {0} with {1}.'.format(tbl_name, shadow_tbl_name))
+    late_count = swap_tables(engine, tbl_name, shadow_tbl_name, unique_col, partition_list, shadow_partition_list)
+
+    logger.info("""Loaded compounds: {0}; Carried over compounds: {1}; Final count in the DB: {2}""".format(
+        loaded_count, carried_count + late_count, new_tbl_count + late_count))
+    logger.warning("""Previous table kept as {0}_old. Views and grants on {0} now reference it; recreate them on {0} and drop {0}_old.""".format(
+        tbl_name))
 
 def load_backfile2(
-    engine: Engine,
+    engine: 'Engine',
     unique_col: List[str],
     logger: logging.Logger,
     ftp_usr: str,
@@ -247,6 +688,8 @@ def load_backfile2(
     Loads backfiles for a specified range in years.
     '''
 
+    import pandas as pd
+
     # connecting to FTP server
     ftp = ftp_connect(ftp_usr, ftp_psw)
 
@@ -338,8 +781,7 @@ def load_backfile2(
     logger.info('Adding primary key.')
     engine.execute("""ALTER TABLE "{0}" ADD PRIMARY KEY ("{1}")""".format(tbl_name, unique_col[0]))
 
-def load_frontfile(
-    engine: Engine,
+def fetch_frontfile(
     unique_col: List[str],
     logger: logging.Logger,
     ftp_usr: str,
@@ -347,11 +789,12 @@ def load_frontfile(
     custom_day: Optional[int]=None,
     custom_month: Optional[int]=None,
     custom_year: Optional[int]=None
-    ) -> None:
+    ) -> Tuple['pd.DataFrame', List[str]]:
 
     '''
     Fetches frontfiles for a specific date or date range.
     Default behaviour - if no custom date is provided records for today are fetched.
+    Returns the records together with the loaded tsv file names and exits if none were found.
     '''
 
     # connecting to FTP server
@@ -401,7 +844,9 @@ def load_frontfile(
     ftp.cwd(parent_dir)
 
     # iterating over a list of directory paths
-    df = pd.DataFrame()
+    # pandas is only imported once a directory with records is found
+    df_list = []
+    tsv_list = []
     for ff_dir in frontfile_dir_list:
         try:
             ftp.cwd(parent_dir)
@@ -423,20 +868,52 @@ def load_frontfile(
             logger.info('Empty tsv file for: {}'.format(', '.join([value for key, value in tsv_dir_dict.items()])))
             continue
 
-        df = pd.concat([df, frontfile_df])
-        df.drop_duplicates(subset=unique_col, keep='first', inplace=True)
+        df_list.append(frontfile_df)
+        tsv_list.extend(tsv_dir_dict.values())
 
     ftp.quit()
 
-    if df.empty:
+    if not df_list:
         logger.info('Did not find records to write.')
         sys.exit()
 
+    import pandas as pd
+
+    df = pd.concat(df_list)
+    df.drop_duplicates(subset=unique_col, keep='first', inplace=True)
+
+    return df, tsv_list
+
+def load_frontfile(
+    engine: 'Engine',
+    unique_col: List[str],
+    logger: logging.Logger,
+    df: 'pd.DataFrame',
+    tsv_list: List[str],
+    partition_list: Optional[List[str]]=None,
+    maintenance_work_mem: Optional[str]=None,
+    upsert: Optional[bool]=False
+    ) -> None:
+
+    '''
+    Writes fetched frontfile records to the DB.
+    Upsert mode replaces stored compounds whose content hash differs from the frontfile.
+    '''
+
     # writting fronfiles to DB
-    logger.info('Loading {} data to SureChEMBL schema in DB.'.format(
-        ', '.join([value for key, value in tsv_dir_dict.items()])))
+    logger.info('Loading {} data to SureChEMBL schema in DB.'.format(', '.join(tsv_list)))
 
     old_tbl_count = count_rows(engine, tbl_name)
+    cmpd_count = len(df)
+
+    changed_count = 0
+    if upsert is True:
+        # comparing content hashes while the primary key is still in place
+        df, changed_count = upsert_rows(engine, tbl_name, unique_col, df)
+
+        if df.empty:
+            logger.info('No new compounds; Changed compounds: {0}'.format(changed_count))
+            return
 
     # dropping primary key and foreign key
     try:
@@ -444,29 +921,31 @@ def load_frontfile(
     except Exception as e:
         logger.info('There was an issue while dropping constraints.\n{}'.format(e))
 
-    dfloader(df, engine, tbl_name, unique_col=unique_col)
-    logger.info('Finished loading {}.'.format(', '.join([value for key, value in tsv_dir_dict.items()])))
+    dfloader(df, engine, tbl_name, unique_col=unique_col, partition_list=partition_list)
+    logger.info('Finished loading {}.'.format(', '.join(tsv_list)))
 
     logger.info('Adding primary key.')
-    engine.execute("""ALTER TABLE "{0}" ADD PRIMARY KEY ("{1}")""".format(tbl_name, unique_col[0]))
+    add_primary_key(engine, tbl_name, unique_col, partition_list, maintenance_work_mem)
 
     new_tbl_count = count_rows(engine, tbl_name)
-    logger.info("""Compounds: {0}; New compounds: {1}; Final count in the DB: {2}""".format(
-        len(df), new_tbl_count - old_tbl_count, new_tbl_count
+    logger.info("""Compounds: {0}; New compounds: {1}; Changed compounds: {2}; Final count in the DB: {3}""".format(
+        cmpd_count, new_tbl_count - old_tbl_count, changed_count, new_tbl_count
         )
     )
 
 def dfloader(
-    df: pd.DataFrame,
-    engine: Engine,
+    df: 'pd.DataFrame',
+    engine: 'Engine',
     tbl_name: str,
     unique_col: Optional[List[str]]=None,
-    drop_duplicates: Optional[bool]=True
+    drop_duplicates: Optional[bool]=True,
+    partition_list: Optional[List[str]]=None
     ) -> None:
 
     '''
     Function to write pandas table SQL and drop duplicates.
     Postgres writes speed are drastically boosted due to use of COPY.
+    For a partitioned table chunks are written and partitions deduplicated concurrently.
     '''
 
     def psql_insert_copy(table, conn, keys, data_iter):
@@ -491,31 +970,134 @@ def dfloader(
                 table_name, columns)
             cur.copy_expert(sql=sql, file=s_buf)
 
-    if engine.dialect.driver == 'psycopg2':
-        df.to_sql(tbl_name, engine, if_exists='append', index=False, method=psql_insert_copy,
-            chunksize=10**6)
+    def write_df(df_chunk):
+        if engine.dialect.driver == 'psycopg2':
+            df_chunk.to_sql(tbl_name, engine, if_exists='append', index=False, method=psql_insert_copy,
+                chunksize=10**6)
+        else:
+            df_chunk.to_sql(tbl_name, engine, if_exists='append', index=False, method='multi',
+                chunksize=10**6)
+
+    if partition_list:
+        # rows are routed to partitions by Postgres so chunks can be copied in parallel
+        run_concurrently(write_df, split_df(df, len(partition_list)), engine.pool.size())
     else:
-        df.to_sql(tbl_name, engine, if_exists='append', index=False, method='multi',
-            chunksize=10**6)
+        write_df(df)
 
     # dropping duplicates in SQL table
     if drop_duplicates is True:
-        if engine.dialect.driver in ('psycopg2', 'mysqldb'):
-            sql_query = """
-                DELETE FROM "{0}" T1
-                    USING "{0}" T2
-                WHERE T1.ctid < T2.ctid
-                    AND T1."{1}"=T2."{1}"
-            """.format(tbl_name, unique_col[0])
+        drop_sql_duplicates(engine, tbl_name, unique_col, partition_list)
+
+def drop_sql_duplicates(
+    engine: 'Engine',
+    tbl_name: str,
+    unique_col: List[str],
+    partition_list: Optional[List[str]]=None
+    ) -> None:
+
+    def dedup_partition(name):
+        engine.execute("""
+            DELETE FROM "{0}" T1
+                USING "{0}" T2
+            WHERE T1.ctid < T2.ctid
+                AND T1."{1}"=T2."{1}"
+        """.format(name, unique_col[0]))
+
+    if partition_list:
+        # duplicates of a hash partition key always end up in the same partition
+        run_concurrently(dedup_partition, partition_list, engine.pool.size())
+        return
+
+    if engine.dialect.driver in ('psycopg2', 'mysqldb'):
+        sql_query = """
+            DELETE FROM "{0}" T1
+                USING "{0}" T2
+            WHERE T1.ctid < T2.ctid
+                AND T1."{1}"=T2."{1}"
+        """.format(tbl_name, unique_col[0])
+    else:
+        sql_query = """
+            DELETE FROM "{0}"
+            WHERE rowid not in
+            (SELECT MIN(rowid)
+                FROM "{0}"
+                GROUP BY "{1}")
+        """.format(tbl_name, unique_col[0])
+    engine.execute(sql_query)
+
+def create_db_engine(
+    conn_info: Dict[str, str],
+    postgres_schema: Optional[str]=None,
+    partitions: Optional[int]=None
+    ) -> 'Engine':
+
+    from sqlalchemy import create_engine, exc
+    from sqlalchemy.engine.url import URL
+
+    # one pooled connection per partition for concurrent loads and index builds
+    engine_kwargs = {'pool_size': partitions} if partitions is not None else {}
+
+    # creating engine for database
+    if postgres_schema is not None and conn_info['drivername'] == 'postgresql+psycopg2':
+        engine = create_engine(URL(**conn_info),
+            connect_args={'options':'-csearch_path={0}'.format(postgres_schema)}, **engine_kwargs)
+    elif conn_info['database'] == 'sqlite://':
+        engine = create_engine('sqlite://')
+    else:
+        engine = create_engine(URL(**conn_info), **engine_kwargs)
+
+    # testing connection
+    try:
+        connection = engine.connect()
+        connection.close()
+    except exc.SQLAlchemyError as e:
+        raise exc.SQLAlchemyError("Failed to connect to '{0}'. Terminating.".format(engine.url.database))
+
+    return engine
+
+def prepare_table(
+    engine: 'Engine',
+    unique_col: List[str],
+    partitions: Optional[int]=None
+    ) -> List[str]:
+
+    '''
+    Creates the destination table if missing, migrates older tables and returns its partitions.
+    '''
+
+    from sqlalchemy import inspect, MetaData, Table, Column, Integer, String, Text
+
+    # checking if SQL table exists
+    if not engine.dialect.has_table(engine, tbl_name):
+        logger.warning('Destination SQL table ({0}) does not exists in DB.'.format(tbl_name))
+
+        if partitions is not None:
+            logger.info('Creating SQL table with {0} hash partitions'.format(partitions))
+            create_partitioned_table(engine, tbl_name, unique_col, partitions)
         else:
-            sql_query = """
-                DELETE FROM "{0}"
-                WHERE rowid not in
-                (SELECT MIN(rowid)
-                    FROM "{0}"
-                    GROUP BY "{1}")
-            """.format(tbl_name, unique_col[0])
-        engine.execute(sql_query)
+            logger.info('Creating SQL table')
+            meta = MetaData()
+            schembl_tbl = Table(
+               tbl_name, meta,
+               Column('schembl_chem_id', Integer, primary_key=True),
+               Column('smiles', Text),
+               Column('std_inchi', Text),
+               Column('std_inchikey', String(27)),
+               Column('content_hash', String(32))
+            )
+            meta.create_all(engine)
+
+    # adding content hash column to tables created by earlier versions
+    if 'content_hash' not in [col['name'] for col in inspect(engine).get_columns(tbl_name)]:
+        logger.info('Adding content_hash column to {0}.'.format(tbl_name))
+        engine.execute("""ALTER TABLE "{0}" ADD COLUMN content_hash VARCHAR(32)""".format(tbl_name))
+
+    partition_list = get_partitions(engine, tbl_name)
+    if partitions is not None and len(partition_list) != partitions:
+        logger.warning('Existing table {0} has {1} partitions while {2} were requested. Using the existing layout.'.format(
+            tbl_name, len(partition_list), partitions))
+
+    return partition_list
 
 def surechembl_mini_client(
     ftp_user: str,
@@ -527,7 +1109,12 @@ def surechembl_mini_client(
     custom_month: Optional[int]=None,
     custom_year: Optional[int]=None,
     start_year: Optional[int]=1950,
-    end_year: Optional[int]=2018
+    end_year: Optional[int]=2018,
+    partitions: Optional[int]=None,
+    maintenance_work_mem: Optional[str]=None,
+    upsert: Optional[bool]=False,
+    rebuild: Optional[bool]=False,
+    min_loaded_ratio: Optional[float]=0.5
     ) -> None:
 
     global tbl_name
@@ -541,43 +1128,35 @@ def surechembl_mini_client(
         os.path.join(path, '{0}.log'.format(os.path.split(__file__)[-1].strip('.py'))),
         stream_level=logging.INFO)
 
-    # creating engine for database
-    if postgres_schema is not None and conn_info['drivername'] == 'postgresql+psycopg2':
-        engine = create_engine(URL(**conn_info),
-            connect_args={'options':'-csearch_path={0}'.format(postgres_schema)})
-    elif conn_info['database'] == 'sqlite://':
-        engine = create_engine('sqlite://')
-    else:
-        engine = create_engine(URL(**conn_info))
-
-    # testing connection
-    try:
-        connection = engine.connect()
-        connection.close()
-    except exc.SQLAlchemyError as e:
-        raise exc.SQLAlchemyError("Failed to connect to '{0}'. Terminating.".format(engine.url.database))
-
-    # checking if SQL table exists
-    if not engine.dialect.has_table(engine, tbl_name):
-        logger.warning('Destination SQL table ({0}) does not exists in DB.'.format(tbl_name))
-
-        logger.info('Creating SQL table')
-        meta = MetaData()
-        schembl_tbl = Table(
-           tbl_name, meta,
-           Column('schembl_chem_id', Integer, primary_key=True),
-           Column('smiles', Text),
-           Column('std_inchi', Text),
-           Column('std_inchikey', String(27))
-        )
-        meta.create_all(engine)
+    if partitions is not None and conn_info['drivername'] != 'postgresql+psycopg2':
+        raise ValueError('Partitioned table is only supported for Postgres.')
+    if partitions is not None and partitions < 1:
+        raise ValueError('Number of partitions must be a positive integer.')
+    if maintenance_work_mem is not None:
+        check_memory_setting(maintenance_work_mem)
+    if rebuild is True and conn_info['drivername'] != 'postgresql+psycopg2':
+        raise ValueError('Rebuild mode is only supported for Postgres.')
+    if rebuild is True and frontfile is True:
+        raise ValueError('Rebuild mode only works with backfiles.')
+    if upsert is True and frontfile is not True:
+        raise ValueError('Upsert mode only works with frontfiles.')
 
     logger.info('\nRetrieving a map for SureChEMBL to InChI.')
 
     if frontfile is True:
-        load_frontfile(engine, unique_col, logger, ftp_user, ftp_psw, custom_day=custom_day, custom_month=custom_month, custom_year=custom_year)
+        # exits before connecting to the DB if there is nothing to load
+        df, tsv_list = fetch_frontfile(unique_col, logger, ftp_user, ftp_psw, custom_day=custom_day,
+            custom_month=custom_month, custom_year=custom_year)
+        engine = create_db_engine(conn_info, postgres_schema, partitions)
+        partition_list = prepare_table(engine, unique_col, partitions)
+        load_frontfile(engine, unique_col, logger, df, tsv_list, partition_list=partition_list,
+            maintenance_work_mem=maintenance_work_mem, upsert=upsert)
     else:
-        load_backfile(engine, unique_col, logger, ftp_user, ftp_psw, start_year=start_year, end_year=end_year)
+        engine = create_db_engine(conn_info, postgres_schema, partitions)
+        partition_list = prepare_table(engine, unique_col, partitions)
+        load_backfile(engine, unique_col, logger, ftp_user, ftp_psw, start_year=start_year, end_year=end_year,
+            partition_list=partition_list, maintenance_work_mem=maintenance_work_mem, rebuild=rebuild,
+            min_loaded_ratio=min_loaded_ratio)
 
 def main():
 
@@ -632,6 +1211,9 @@ def main():
     optional.add_argument('-ff', '--frontfile',
         help='Fronfile fetching mode. Not including the flag defaults to backfiles.', action='store_true')
 
+    optional.add_argument('-u', '--upsert',
+        help='Fronfile fetching mode. Update stored compounds whose structure has changed.', action='store_true')
+
     optional.add_argument('-cd', '--custom_day',
         help='Fronfile fetching mode. Specify day.', default=None, type=int)
     optional.add_argument('-cm', '--custom_month',
@@ -642,6 +1224,20 @@ def main():
         help='Fronfile fetching mode. Specify start year for year range.', default=1950, type=int)
     optional.add_argument('-ey', '--end_year',
         help='Fronfile fetching mode. Specify end year for year range.', default=2018, type=int)
+    optional.add_argument('-rb', '--rebuild',
+        help='Backfile fetching mode. Load into a shadow table and swap it with the live table once loaded. Only works if db_type is Postgres.',
+        action='store_true')
+    optional.add_argument('-mlr', '--min_loaded_ratio',
+        help='Backfile fetching mode. Minimum ratio of rebuilt to live row count required to swap the tables.',
+        default=0.5, type=float)
+
+    # Partitioning arguments
+    optional.add_argument('-np', '--partitions',
+        help='Number of hash partitions to create the destination table with. Only works if db_type is Postgres.',
+        default=None, type=int)
+    optional.add_argument('-mwm', '--maintenance_work_mem',
+        help='Postgres maintenance_work_mem used while building primary keys, e.g. 2GB. Applied per partition build, which run concurrently. Defaults to the server setting.',
+        default=None, type=str)
     args = parser.parse_args()
 
     # database type to drivername
@@ -655,7 +1251,8 @@ def main():
     }
 
     surechembl_mini_client(args.ftp_usr, args.ftp_psw, conn_info, args.postgres_schema, args.frontfile,
-        args.custom_day, args.custom_month, args.custom_year, args.start_year, args.end_year)
+        args.custom_day, args.custom_month, args.custom_year, args.start_year, args.end_year,
+        args.partitions, args.maintenance_work_mem, args.upsert, args.rebuild, args.min_loaded_ratio)
 
 if __name__ == "__main__":
 
@@ -1,6 +1,14 @@
 #!/usr/bin/env python
 
 import unittest
+import sys
+import os
+import tempfile
+import importlib
+import subprocess
+import threading
+from contextlib import contextmanager
+from unittest import mock
 import sqlite3
 from sqlite3 import Error
 
@@ -34,6 +42,409 @@ class surechembl_mini_client_test(unittest.TestCase):
     def test_backfile(self):
         surechembl_mini_client(ftp_usr, ftp_psw, conn_info, frontfile=False, start_year=1950, end_year=1970)
 
+class RecordingResult(list):
+
+    def fetchall(self):
+        return list(self)
+
+    def fetchone(self):
+        return self[0]
+
+    @property
+    def rowcount(self):
+        return len(self)
+
+class RecordingEngine:
+
+    '''
+    Engine stub recording whitespace-normalised SQL sent through execute() and begin().
+    '''
+
+    def __init__(self, driver='psycopg2', results=None, pool_size=4):
+        self.statements = []
+        self.params = []
+        self.results = results or {}
+        self.dialect = mock.Mock(driver=driver)
+        self.pool = mock.Mock(size=mock.Mock(return_value=pool_size))
+        self._lock = threading.Lock()
+
+    def execute(self, sql, *params):
+        with self._lock:
+            self.statements.append(' '.join(str(sql).split()))
+            self.params.append(params)
+        for key, rows in self.results.items():
+            if key in str(sql):
+                return RecordingResult(rows)
+        return RecordingResult()
+
+    @contextmanager
+    def begin(self):
+        yield self
+
+class partitioned_table_test(unittest.TestCase):
+
+    tbl_name = 'schembl_chemical_structure'
+    unique_col = ['schembl_chem_id']
+    partition_list = ['schembl_chemical_structure_p0', 'schembl_chemical_structure_p1']
+
+    def test_get_partitions(self):
+        from surechembl_mini_client import get_partitions
+
+        engine = RecordingEngine(driver='pysqlite')
+        self.assertEqual(get_partitions(engine, self.tbl_name), [])
+        self.assertEqual(engine.statements, [])
+
+        engine = RecordingEngine(results={'pg_inherits': [(name,) for name in self.partition_list]})
+        self.assertEqual(get_partitions(engine, self.tbl_name), self.partition_list)
+        self.assertIn('''WHERE i.inhparent = '"schembl_chemical_structure"'::regclass''', engine.statements[0])
+
+    def test_create_partitioned_table(self):
+        from surechembl_mini_client import create_partitioned_table
+
+        engine = RecordingEngine()
+        create_partitioned_table(engine, self.tbl_name, self.unique_col, 3)
+
+        self.assertEqual(len(engine.statements), 4)
+        self.assertIn('PRIMARY KEY ("schembl_chem_id") ) PARTITION BY HASH ("schembl_chem_id")', engine.statements[0])
+        for i, sql in enumerate(engine.statements[1:]):
+            self.assertEqual(sql, 'CREATE TABLE "schembl_chemical_structure_p{0}" PARTITION OF '
+                '"schembl_chemical_structure" FOR VALUES WITH (MODULUS 3, REMAINDER {0})'.format(i))
+
+        engine = RecordingEngine()
+        create_partitioned_table(engine, self.tbl_name, self.unique_col, 1, primary_key=False, unlogged=True)
+
+        self.assertNotIn('PRIMARY KEY', engine.statements[0])
+        self.assertTrue(engine.statements[1].startswith('CREATE UNLOGGED TABLE'))
+
+    def test_split_df(self):
+        import pandas as pd
+        from surechembl_mini_client import split_df
+
+        df = pd.DataFrame({'schembl_chem_id': range(10)})
+
+        self.assertEqual([len(chunk) for chunk in split_df(df, 3)], [4, 4, 2])
+        self.assertEqual([len(chunk) for chunk in split_df(df.head(2), 4)], [1, 1])
+        self.assertEqual(split_df(df.head(0), 4), [])
+        self.assertEqual(pd.concat(split_df(df, 3))['schembl_chem_id'].tolist(), list(range(10)))
+
+    def test_dfloader_partitioned(self):
+        import pandas as pd
+        from surechembl_mini_client import dfloader
+
+        df = pd.DataFrame({'schembl_chem_id': range(5)})
+        for n_rows, n_chunks in [(5, 2), (0, 0)]:
+            engine = RecordingEngine()
+            with mock.patch.object(pd.DataFrame, 'to_sql') as to_sql:
+                dfloader(df.head(n_rows), engine, self.tbl_name, unique_col=self.unique_col,
+                    partition_list=self.partition_list)
+
+            self.assertEqual(to_sql.call_count, n_chunks)
+            self.assertEqual(sorted(sql.split('"')[1] for sql in engine.statements), self.partition_list)
+            self.assertTrue(all(sql.startswith('DELETE FROM') for sql in engine.statements))
+
+    def test_add_primary_key_partitioned(self):
+        from surechembl_mini_client import add_primary_key
+
+        engine = RecordingEngine()
+        add_primary_key(engine, self.tbl_name, self.unique_col, self.partition_list, '512MB')
+
+        add_sql = [sql for sql in engine.statements if 'ADD PRIMARY KEY' in sql]
+        self.assertEqual(sorted(add_sql[:-1]), [
+            'ALTER TABLE "{0}" ADD PRIMARY KEY ("schembl_chem_id")'.format(name) for name in self.partition_list])
+        self.assertEqual(add_sql[-1], 'ALTER TABLE "schembl_chemical_structure" ADD PRIMARY KEY ("schembl_chem_id")')
+        self.assertEqual(engine.statements.count("SET LOCAL maintenance_work_mem = '512MB'"), 3)
+
+        # leftover partition keys are dropped before each partition build, never the parent key
+        drop_sql = [sql for sql in engine.statements if 'DROP CONSTRAINT' in sql]
+        self.assertEqual(sorted(drop_sql), [
+            'ALTER TABLE "{0}" DROP CONSTRAINT IF EXISTS "{0}_pkey"'.format(name) for name in self.partition_list])
+        for name in self.partition_list:
+            self.assertLess(engine.statements.index('ALTER TABLE "{0}" DROP CONSTRAINT IF EXISTS "{0}_pkey"'.format(name)),
+                engine.statements.index('ALTER TABLE "{0}" ADD PRIMARY KEY ("schembl_chem_id")'.format(name)))
+
+    def test_maintenance_work_mem(self):
+        from surechembl_mini_client import add_primary_key
+
+        engine = RecordingEngine()
+        add_primary_key(engine, self.tbl_name, self.unique_col)
+        self.assertEqual(engine.statements, ['ALTER TABLE "schembl_chemical_structure" ADD PRIMARY KEY ("schembl_chem_id")'])
+
+        for value in ["1GB'; DROP TABLE x; --", 'lots', '']:
+            engine = RecordingEngine()
+            with self.assertRaises(ValueError):
+                add_primary_key(engine, self.tbl_name, self.unique_col, maintenance_work_mem=value)
+            self.assertEqual(engine.statements, [])
+
+class rebuild_test(unittest.TestCase):
+
+    tbl_name = 'schembl_chemical_structure'
+    shadow_tbl_name = 'schembl_chemical_structure_shadow'
+    unique_col = ['schembl_chem_id']
+    scmc = importlib.import_module('surechembl_mini_client.surechembl_mini_client')
+
+    def test_swap_tables(self):
+        from surechembl_mini_client import swap_tables
+
+        engine = RecordingEngine(results={'INSERT INTO': [None] * 3})
+        late_count = swap_tables(engine, self.tbl_name, self.shadow_tbl_name, self.unique_col,
+            [self.tbl_name + '_p0'], [self.shadow_tbl_name + '_p0'])
+
+        self.assertEqual(late_count, 3)
+        self.assertEqual(engine.statements[0], 'LOCK TABLE "schembl_chemical_structure" IN EXCLUSIVE MODE')
+        self.assertTrue(engine.statements[1].startswith('INSERT INTO "schembl_chemical_structure_shadow"'))
+        renames = [sql for sql in engine.statements if 'RENAME' in sql]
+        self.assertEqual(renames, [
+            'ALTER TABLE "schembl_chemical_structure" RENAME TO "schembl_chemical_structure_old"',
+            'ALTER INDEX IF EXISTS "schembl_chemical_structure_pkey" RENAME TO "schembl_chemical_structure_old_pkey"',
+            'ALTER TABLE "schembl_chemical_structure_p0" RENAME TO "schembl_chemical_structure_old_p0"',
+            'ALTER INDEX IF EXISTS "schembl_chemical_structure_p0_pkey" RENAME TO "schembl_chemical_structure_old_p0_pkey"',
+            'ALTER TABLE "schembl_chemical_structure_shadow" RENAME TO "schembl_chemical_structure"',
+            'ALTER INDEX IF EXISTS "schembl_chemical_structure_shadow_pkey" RENAME TO "schembl_chemical_structure_pkey"',
+            'ALTER TABLE "schembl_chemical_structure_shadow_p0" RENAME TO "schembl_chemical_structure_p0"',
+            'ALTER INDEX IF EXISTS "schembl_chemical_structure_shadow_p0_pkey" RENAME TO "schembl_chemical_structure_p0_pkey"'
+        ])
+        self.assertFalse(any(sql.startswith('DROP') for sql in engine.statements))
+
+    def run_rebuild_table(self, expected_count, loaded_count, live_count, carried_count, replaced_count=0):
+        from surechembl_mini_client import rebuild_table
+
+        scmc = self.scmc
+        logger = mock.Mock()
+        # row counts as the tables would report them; carrying over grows the shadow table
+        counts = {self.shadow_tbl_name: loaded_count, self.tbl_name: live_count}
+
+        def carry_over_rows(*args):
+            counts[self.shadow_tbl_name] += carried_count
+            return carried_count
+
+        engine = RecordingEngine(results={'IS DISTINCT FROM': [(replaced_count,)]})
+        with mock.patch.object(scmc, 'count_rows', side_effect=lambda engine, name: counts[name]), \
+                mock.patch.object(scmc, 'carry_over_rows', side_effect=carry_over_rows), \
+                mock.patch.object(scmc, 'drop_sql_duplicates'), \
+                mock.patch.object(scmc, 'set_logged'), \
+                mock.patch.object(scmc, 'add_primary_key'), \
+                mock.patch.object(scmc, 'swap_tables', return_value=0) as swap_tables:
+            rebuild_table(engine, self.tbl_name, self.shadow_tbl_name, self.unique_col, logger,
+                expected_count=expected_count, min_loaded_ratio=0.5)
+
+        return swap_tables, logger
+
+    def test_rebuild_table_validation(self):
+        # full backfile load with frontfile rows carried over
+        swap_tables, logger = self.run_rebuild_table(100, 100, 110, 10)
+        self.assertEqual(swap_tables.call_count, 1)
+        self.assertIn('Final count in the DB: 110', logger.info.call_args[0][0])
+
+        # rows lost while loading, a partial year range and an empty load keep the live table
+        for counts in [(100, 95, 110, 10), (20, 20, 110, 90), (0, 0, 110, 110)]:
+            with self.assertRaises(SystemExit) as cm:
+                self.run_rebuild_table(*counts)
+            self.assertEqual(cm.exception.code, 1)
+
+    def test_rebuild_table_reports_replaced_rows(self):
+        swap_tables, logger = self.run_rebuild_table(100, 100, 100, 0, replaced_count=3)
+
+        self.assertEqual(swap_tables.call_count, 1)
+        self.assertTrue(any(call[0][0].startswith('3 compounds') for call in logger.warning.call_args_list))
+
+    def test_load_backfile_rebuild(self):
+        import pandas as pd
+
+        scmc = self.scmc
+        engine = RecordingEngine()
+        engine.dialect.has_table.return_value = False
+        ftp = mock.Mock()
+        ftp.nlst.side_effect = lambda: ['1950_1960'] if ftp.cwd.call_count == 1 else ['a.chemicals.tsv.gz']
+        year_df = pd.DataFrame({'schembl_chem_id': [1, 2]})
+
+        for rebuild, load_tbl_name, drop_duplicates in [
+                (True, self.shadow_tbl_name, False), (False, self.tbl_name, True)]:
+            ftp.cwd.reset_mock()
+            cwd = os.getcwd()
+            with tempfile.TemporaryDirectory() as tmp_dir, \
+                    mock.patch.object(scmc, 'tbl_name', self.tbl_name, create=True), \
+                    mock.patch.object(scmc, 'ftp_connect', return_value=ftp), \
+                    mock.patch.object(scmc, 'parse_chemicals_file', return_value=year_df), \
+                    mock.patch.object(scmc, 'create_shadow_table'), \
+                    mock.patch.object(scmc, 'get_partitions', return_value=[]), \
+                    mock.patch.object(scmc, 'add_primary_key'), \
+                    mock.patch.object(scmc, 'rebuild_table') as rebuild_table, \
+                    mock.patch.object(scmc, 'dfloader') as dfloader:
+                os.chdir(tmp_dir)
+                try:
+                    scmc.load_backfile(engine, self.unique_col, mock.Mock(), '', '', rebuild=rebuild)
+                finally:
+                    os.chdir(cwd)
+
+            self.assertEqual(dfloader.call_args[0][2], load_tbl_name)
+            self.assertIs(dfloader.call_args[1]['drop_duplicates'], drop_duplicates)
+            self.assertEqual(rebuild_table.call_count, int(rebuild))
+            if rebuild:
+                self.assertEqual(rebuild_table.call_args[1]['expected_count'], 2)
+
+    def test_rebuild_rejects_frontfile(self):
+        conn_info = {
+            'drivername' : 'postgresql+psycopg2',
+            'username' : '',
+            'password' : '',
+            'host' : '',
+            'port' : '',
+            'database' : ''
+        }
+        with self.assertRaises(ValueError):
+            surechembl_mini_client('', '', conn_info, frontfile=True, rebuild=True)
+
+class content_hash_test(unittest.TestCase):
+
+    def test_content_hash(self):
+        import pandas as pd
+        from surechembl_mini_client import content_hash
+
+        df = pd.DataFrame({
+            'schembl_chem_id': [1, 2, 3],
+            'smiles': ['C', 'C', None],
+            'std_inchi': ['InChI=1S/CH4/h1H4', 'InChI=1S/CH4/h1H4', 'InChI=1S/CH4/h1H4'],
+            'std_inchikey': ['VNWKTOKETHGBQD-UHFFFAOYSA-N', 'VNWKTOKETHGBQD-UHFFFAOYSA-M',
+                'VNWKTOKETHGBQD-UHFFFAOYSA-N']
+        })
+        hashes = content_hash(df)
+
+        self.assertEqual(hashes.str.len().tolist(), [32, 32, 32])
+        self.assertEqual(len(set(hashes)), 3)
+        self.assertTrue(hashes.equals(content_hash(df.copy())))
+
+class upsert_test(unittest.TestCase):
+
+    tbl_name = 'schembl_chemical_structure'
+    unique_col = ['schembl_chem_id']
+    scmc = importlib.import_module('surechembl_mini_client.surechembl_mini_client')
+
+    # structures stored before hashes were added: 3 is unchanged, 5 has since been corrected
+    stored_structures = [(3, 'CCC', 'c', 'C'), (5, 'stale', 'e', 'E')]
+
+    def get_df(self):
+        import pandas as pd
+        from surechembl_mini_client import content_hash
+
+        df = pd.DataFrame({
+            'schembl_chem_id': [1, 2, 3, 4, 5],
+            'smiles': ['C', 'CC', 'CCC', 'CCCC', 'CCCCC'],
+            'std_inchi': ['a', 'b', 'c', 'd', 'e'],
+            'std_inchikey': ['A', 'B', 'C', 'D', 'E']
+        })
+        df['content_hash'] = content_hash(df)
+
+        # 1 unchanged, 2 changed, 3 and 5 stored before hashes were added, 4 new
+        stored_hashes = {1: df['content_hash'][0], 2: 'outdated', 3: None, 5: None}
+
+        return df, stored_hashes
+
+    def test_select_upsert_rows(self):
+        from surechembl_mini_client import select_upsert_rows
+
+        df, stored_hashes = self.get_df()
+        computed_hashes = {3: df['content_hash'][2], 5: 'stale'}
+        new_df, changed_df, backfill_df = select_upsert_rows(df, stored_hashes, self.unique_col, computed_hashes)
+
+        self.assertEqual(new_df['schembl_chem_id'].tolist(), [4])
+        self.assertEqual(changed_df['schembl_chem_id'].tolist(), [2, 5])
+        self.assertEqual(backfill_df['schembl_chem_id'].tolist(), [3])
+
+        # without a computed hash a stored row with a NULL hash is replaced, never tagged
+        new_df, changed_df, backfill_df = select_upsert_rows(df, stored_hashes, self.unique_col)
+        self.assertEqual(changed_df['schembl_chem_id'].tolist(), [2, 3, 5])
+        self.assertTrue(backfill_df.empty)
+
+    def test_upsert_rows(self):
+        import pandas as pd
+        from surechembl_mini_client import upsert_rows
+
+        scmc = self.scmc
+        df, stored_hashes = self.get_df()
+        engine = RecordingEngine(results={'SELECT': self.stored_structures})
+        with mock.patch.object(scmc, 'get_stored_hashes', return_value=stored_hashes), \
+                mock.patch.object(pd.DataFrame, 'to_sql', autospec=True) as to_sql:
+            new_df, changed_count = upsert_rows(engine, self.tbl_name, self.unique_col, df)
+
+        self.assertEqual(new_df['schembl_chem_id'].tolist(), [4])
+        self.assertEqual(changed_count, 2)
+        self.assertEqual(engine.statements, [
+            'SELECT "schembl_chem_id", smiles, std_inchi, std_inchikey FROM "schembl_chemical_structure" '
+                'WHERE "schembl_chem_id" IN (3, 5)',
+            'UPDATE "schembl_chemical_structure" SET content_hash = :content_hash WHERE "schembl_chem_id" = :id',
+            'DELETE FROM "schembl_chemical_structure" WHERE "schembl_chem_id" IN (2, 5)'
+        ])
+        # only the unchanged row gets its hash filled in, the stale row 5 is replaced
+        self.assertEqual(engine.params[1], ([{'content_hash': df['content_hash'][2], 'id': 3}],))
+        self.assertEqual(to_sql.call_count, 1)
+        self.assertEqual(to_sql.call_args[0][0]['schembl_chem_id'].tolist(), [2, 5])
+        self.assertIs(to_sql.call_args[0][2], engine)
+
+    def test_upsert_rejects_backfile(self):
+        with self.assertRaises(ValueError):
+            surechembl_mini_client('', '', {'drivername': 'postgresql+psycopg2'}, frontfile=False, upsert=True)
+
+    def test_batches(self):
+        from surechembl_mini_client import get_stored_hashes, delete_rows
+
+        engine = RecordingEngine(results={'SELECT': [(1, 'hash')]})
+        self.assertEqual(get_stored_hashes(engine, self.tbl_name, self.unique_col, list(range(2500))), {1: 'hash'})
+        delete_rows(engine, self.tbl_name, self.unique_col, list(range(2500)))
+
+        self.assertEqual(len(engine.statements), 6)
+        self.assertTrue(all(sql.split('IN (')[1].count(',') + 1 <= 1000 for sql in engine.statements))
+
+class import_time_test(unittest.TestCase):
+
+    # seconds allowed for importing the package, excluding interpreter startup
+    import_time_budget = 0.1
+    # best of several runs so that a loaded machine does not fail the budget
+    import_runs = 5
+    lazy_modules = ['pandas', 'sqlalchemy', 'cx_Oracle', 'psycopg2', 'MySQLdb']
+    # directory containing the package under test
+    repo_dir = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+    def run_import(self):
+        code = (
+            'import sys, time\n'
+            't0 = time.perf_counter()\n'
+            'import surechembl_mini_client\n'
+            'print(time.perf_counter() - t0)\n'
+            'print(",".join(m for m in {0!r} if m in sys.modules))\n'
+            'print(surechembl_mini_client.__file__)\n'.format(self.lazy_modules)
+        )
+        env = dict(os.environ, PYTHONPATH=self.repo_dir)
+        out = subprocess.run([sys.executable, '-c', code], check=True, cwd=self.repo_dir, env=env,
+            stdout=subprocess.PIPE, universal_newlines=True).stdout.splitlines()
+
+        return float(out[0]), out[1], out[2]
+
+    def test_import_time(self):
+        runs = [self.run_import() for _ in range(self.import_runs)]
+        import_time, loaded, package_file = min(runs)
+
+        self.assertTrue(package_file.startswith(self.repo_dir))
+        self.assertEqual(loaded, '', 'Heavy modules imported eagerly: {0}'.format(loaded))
+        self.assertLess(import_time, self.import_time_budget)
+
+class empty_frontfile_test(unittest.TestCase):
+
+    scmc = importlib.import_module('surechembl_mini_client.surechembl_mini_client')
+
+    def test_no_db_work_without_records(self):
+        scmc = self.scmc
+        with mock.patch.object(scmc, 'ftp_connect'), \
+                mock.patch.object(scmc, 'get_tsv_dir', return_value={}), \
+                mock.patch.object(scmc, 'AppLogger'), \
+                mock.patch.object(scmc, 'create_db_engine') as create_db_engine, \
+                mock.patch.object(scmc, 'prepare_table') as prepare_table:
+            with self.assertRaises(SystemExit):
+                surechembl_mini_client('', '', {'drivername': 'postgresql+psycopg2'}, frontfile=True,
+                    custom_day=1, custom_month=1, custom_year=2019)
+
+        self.assertEqual(create_db_engine.call_count, 0)
+        self.assertEqual(prepare_table.call_count, 0)
+
 if __name__ == '__main__':
 
     unittest.main()